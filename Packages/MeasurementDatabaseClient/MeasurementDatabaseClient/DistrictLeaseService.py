@@ -0,0 +1,130 @@
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+import pyodbc
+
+from MeasurementDatabaseClient.repositories import DistrictLeaseRepository
+
+
+class DistrictLease(object):
+    """
+    A lease on one water district held by this importer instance.  While the lease is held a background thread renews
+    it every heartbeat interval.  If a renewal fails (e.g. because this instance stalled long enough for the lease to
+    expire and another instance took it over, or the lease table could not be reached) Lost is set and the holder
+    should not write the district's data.
+    """
+    def __init__(self, service, district_number: str):
+        self.__service = service
+        self.DistrictNumber = district_number
+        self.Lost = False
+        self.Error = None
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__heartbeat_loop,
+                                         name="DistrictLease-{}".format(district_number),
+                                         daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        # Only hold the district for the cool-down period if the import actually finished
+        self.release(completed=type_ is None)
+
+    def release(self, completed=True):
+        """
+        Stops renewing the lease and gives it up
+        :param completed: True if the district was imported, in which case other instances will leave it alone for the
+                    service's CompletedHold period
+        :return: Nothing
+        """
+        if self.__stop.is_set():
+            return
+        self.__stop.set()
+        self.__thread.join()
+        if not self.Lost:
+            self.__service.release(self.DistrictNumber, completed)
+
+    def __heartbeat_loop(self):
+        """
+        Renews the lease until released.  Uses its own repository since DB-API connections are not shared between
+        threads.  Any error renewing the lease counts as losing it: once renewals stop the lease expires and another
+        instance may take the district, so carrying on would fail open.
+        """
+        try:
+            with self.__service.new_repository() as repo:
+                while not self.__stop.wait(self.__service.HeartbeatInterval.total_seconds()):
+                    if not repo.heartbeat(self.DistrictNumber, self.__service.Owner, self.__service.LeaseDuration):
+                        self.Lost = True
+                        return
+        except Exception as e:
+            self.Error = e
+            self.Lost = True
+
+
+class DistrictLeaseService(object):
+    """
+    Service that lets several Survey123DataImport instances share the configured surveys between them.  Each instance
+    takes a lease on a water district before importing it, so no two instances import the same district at once, and a
+    district whose holder crashed becomes available again when its lease expires.
+    """
+    def __init__(self, connection_string: str, lease_duration=timedelta(minutes=5),
+                 heartbeat_interval=timedelta(minutes=1), completed_hold=timedelta(0),
+                 owner=None, connect=pyodbc.connect):
+        """
+        :param connection_string: Connection string of the database holding the lease table
+        :param lease_duration: How long a lease lasts without a heartbeat.  This is how long a crashed instance's
+                    districts stay unavailable
+        :param heartbeat_interval: How often held leases are renewed.  Should be well under lease_duration
+        :param completed_hold: How long other instances leave a district alone after it has been imported.  Set this a
+                    bit shorter than the schedule interval so each district is imported once per scheduled run
+        :param owner: Identifier for this instance.  Defaults to host name, process ID and a random suffix
+        :param connect: DB-API connect function (default is pyodbc.connect; sqlite3.connect works for local testing)
+        """
+        self.__connection_string = connection_string
+        self.__connect = connect
+        self.LeaseDuration = lease_duration
+        self.HeartbeatInterval = heartbeat_interval
+        self.CompletedHold = completed_hold
+        self.Owner = owner or "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    def new_repository(self):
+        """
+        Opens a new connection to the lease table
+        :return: DistrictLeaseRepository
+        """
+        return DistrictLeaseRepository(self.__connection_string, connect=self.__connect)
+
+    def prepare(self, district_numbers: list):
+        """
+        Creates the lease table if needed and makes sure every district has a lease row
+        :param district_numbers: Water district numbers of all configured surveys
+        :return: Nothing
+        """
+        with self.new_repository() as repo:
+            repo.create_table()
+            repo.ensure_districts(district_numbers)
+
+    def try_acquire(self, district_number: str):
+        """
+        Tries to take the lease on a water district
+        :param district_number: Water district to lease
+        :return: DistrictLease if this instance now holds the lease, otherwise None
+        """
+        with self.new_repository() as repo:
+            if not repo.try_acquire(district_number, self.Owner, self.LeaseDuration):
+                return None
+        return DistrictLease(self, district_number)
+
+    def release(self, district_number: str, completed=True):
+        """
+        Gives up a lease held by this instance
+        :param district_number: Water district whose lease is being released
+        :param completed: True if the district was imported (holds it for CompletedHold), False to free it immediately
+        :return: Nothing
+        """
+        with self.new_repository() as repo:
+            repo.release(district_number, self.Owner, self.CompletedHold if completed else timedelta(0))
@@ -40,10 +40,14 @@ class WaterDistrictDataService(object):
         except AlreadyGotOneException:
             self.DuplicateRows += 1
 
-    def import_measurements(self, measurements: list):
+    def import_measurements(self, measurements: list, is_cancelled=None):
         """
         Adds a list of data to the database and performs necessary processing such as interpolation for missing days
         :type measurements: list of WdWaterMasterDataMetadata
+        :param is_cancelled: Optional function taking no arguments that returns True if the import should stop.  It is
+                    checked before each row is added and again just before committing; if it returns True everything
+                    added so far is rolled back
+        :return: True if the measurements were committed, False if the import was cancelled
         """
         self.__reset_tracker()
         self.__data_repo = WdWaterMasterDataRepository(self.__connection_string)
@@ -58,12 +62,17 @@ class WaterDistrictDataService(object):
                 if previous_record is not None:
                     interpolated_rows.extend(self.__interpolate_data(previous_record, data, this_record.DeviceType))
                 previous_record = data
-        for measurement in measurements:
-            self.add_measurement(measurement.Data)
-        for measurement in interpolated_rows:
+        for measurement in [m.Data for m in measurements] + interpolated_rows:
+            if is_cancelled is not None and is_cancelled():
+                self.__data_repo.close()
+                return False
             self.add_measurement(measurement)
+        if is_cancelled is not None and is_cancelled():
+            self.__data_repo.close()
+            return False
         self.__data_repo.complete()
         self.__data_repo.close()
+        return True
 
     def get_earliest_date_of_last_measurement_for_water_district(self, district_number: str):
         """
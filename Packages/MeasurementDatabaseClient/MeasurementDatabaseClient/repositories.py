@@ -1,4 +1,5 @@
 import datetime
+import sqlite3
 
 import pyodbc
 
@@ -245,3 +246,162 @@ class WdWaterMasterDataRepository(Repository):
         if len(invalid_list) == 0:
             return True
         raise InvalidDataException(field_list=invalid_list)
+
+
+class DistrictLeaseRepository(Repository):
+    """
+    Repository for the wdSurveyImportLease table, which coordinates which importer instance is processing which
+    water district.  Every statement commits immediately so that other instances see lease changes right away.
+    The SQL is kept portable so that a sqlite3 database can stand in for SQL Server when testing locally.
+    """
+    __integrity_errors = (pyodbc.IntegrityError, sqlite3.IntegrityError)
+
+    def __init__(self, connection_string: str, connect=pyodbc.connect):
+        """
+        :param connection_string: Connection string (or, for sqlite3, path) of the database holding the lease table
+        :param connect: DB-API connect function used to open the connection (default is pyodbc.connect)
+        """
+        self.__connect = connect
+        super(DistrictLeaseRepository, self).__init__(connection_string)
+
+    def __get_connection__(self, connection_string):
+        return self.__connect(connection_string)
+
+    def create_table(self):
+        """
+        Creates the lease table if it does not already exist
+        :return: Nothing
+        """
+        if self.__table_exists():
+            return
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE [wdSurveyImportLease] ('
+                  '     [DistrictNumber] VARCHAR(10) NOT NULL PRIMARY KEY, '
+                  '     [Owner] VARCHAR(200) NULL, '
+                  '     [HeartbeatAt] DATETIME NULL, '
+                  '     [ExpiresAt] DATETIME NULL)')
+        self.conn.commit()
+
+    def ensure_districts(self, district_numbers: list):
+        """
+        Adds an unowned lease row for each water district that does not already have one
+        :param district_numbers: Water district numbers that leases should exist for
+        :return: Nothing
+        """
+        c = self.conn.cursor()
+        for district_number in district_numbers:
+            try:
+                c.execute('INSERT INTO [wdSurveyImportLease] ([DistrictNumber], [Owner], [HeartbeatAt], [ExpiresAt]) '
+                          'SELECT ?, NULL, NULL, NULL '
+                          'WHERE NOT EXISTS (SELECT 1 FROM [wdSurveyImportLease] WHERE [DistrictNumber]=?)',
+                          (district_number, district_number))
+                self.conn.commit()
+            except self.__integrity_errors:
+                # Another instance inserted the same row between our check and our insert
+                self.conn.rollback()
+
+    def try_acquire(self, district_number: str, owner: str, duration: datetime.timedelta):
+        """
+        Takes the lease on a water district if nobody holds it or the holder's lease has expired.  Lease times come
+        from the database's clock so that instances on hosts with unsynchronized clocks still agree on expiry.
+        :param district_number: Water district to lease
+        :param owner: Identifier of the importer instance asking for the lease
+        :param duration: How long the lease is good for before it must be renewed by a heartbeat
+        :return: True if the lease now belongs to owner, otherwise False
+        """
+        c = self.conn.cursor()
+        c.execute('UPDATE [wdSurveyImportLease] '
+                  'SET [Owner]=?, [HeartbeatAt]={0}, [ExpiresAt]={1} '
+                  'WHERE [DistrictNumber]=? AND ([ExpiresAt] IS NULL OR [ExpiresAt] < {0})'
+                  .format(self.__now_sql(), self.__later_sql()),
+                  (owner, self.__duration_param(duration), district_number))
+        acquired = c.rowcount == 1
+        self.conn.commit()
+        return acquired
+
+    def heartbeat(self, district_number: str, owner: str, duration: datetime.timedelta):
+        """
+        Extends a lease that owner currently holds
+        :param district_number: Water district whose lease is being renewed
+        :param owner: Identifier of the importer instance holding the lease
+        :param duration: How long from now the lease should be good for
+        :return: True if the lease was renewed, False if owner no longer holds it
+        """
+        c = self.conn.cursor()
+        c.execute('UPDATE [wdSurveyImportLease] '
+                  'SET [HeartbeatAt]={0}, [ExpiresAt]={1} '
+                  'WHERE [DistrictNumber]=? AND [Owner]=? AND [ExpiresAt] >= {0}'
+                  .format(self.__now_sql(), self.__later_sql()),
+                  (self.__duration_param(duration), district_number, owner))
+        renewed = c.rowcount == 1
+        self.conn.commit()
+        return renewed
+
+    def release(self, district_number: str, owner: str, hold_for=datetime.timedelta(0)):
+        """
+        Gives up a lease that owner currently holds
+        :param district_number: Water district whose lease is being released
+        :param owner: Identifier of the importer instance holding the lease
+        :param hold_for: How long other instances should leave the district alone (e.g. because it was just imported).
+                    The default releases the district immediately
+        :return: Nothing
+        """
+        c = self.conn.cursor()
+        if hold_for:
+            c.execute('UPDATE [wdSurveyImportLease] '
+                      'SET [HeartbeatAt]={0}, [ExpiresAt]={1} '
+                      'WHERE [DistrictNumber]=? AND [Owner]=?'.format(self.__now_sql(), self.__later_sql()),
+                      (self.__duration_param(hold_for), district_number, owner))
+        else:
+            c.execute('UPDATE [wdSurveyImportLease] '
+                      'SET [HeartbeatAt]={0}, [ExpiresAt]=NULL '
+                      'WHERE [DistrictNumber]=? AND [Owner]=?'.format(self.__now_sql()),
+                      (district_number, owner))
+        self.conn.commit()
+
+    def get_owner(self, district_number: str):
+        """
+        Gets the current holder of a water district's lease
+        :param district_number: Water district to look up
+        :return: Identifier of the holder, or None if the lease is free or has expired
+        """
+        c = self.conn.cursor()
+        c.execute('SELECT [Owner] FROM [wdSurveyImportLease] WHERE [DistrictNumber]=? AND [ExpiresAt] >= {}'
+                  .format(self.__now_sql()),
+                  (district_number,))
+        row = c.fetchone()
+        return None if row is None else row[0]
+
+    def __is_sqlite(self):
+        return isinstance(self.conn, sqlite3.Connection)
+
+    def __now_sql(self):
+        """
+        SQL expression for the database's current UTC time
+        """
+        if self.__is_sqlite():
+            return "STRFTIME('%Y-%m-%d %H:%M:%f', 'now')"
+        return 'GETUTCDATE()'
+
+    def __later_sql(self):
+        """
+        SQL expression for the database's current UTC time plus a duration given as a parameter (see __duration_param)
+        """
+        if self.__is_sqlite():
+            return "STRFTIME('%Y-%m-%d %H:%M:%f', 'now', '+' || ? || ' seconds')"
+        return 'DATEADD(millisecond, ?, GETUTCDATE())'
+
+    def __duration_param(self, duration: datetime.timedelta):
+        if self.__is_sqlite():
+            return duration.total_seconds()
+        return int(duration.total_seconds() * 1000)
+
+    def __table_exists(self):
+        c = self.conn.cursor()
+        try:
+            c.execute("SELECT COUNT(*) FROM [wdSurveyImportLease] WHERE 1=0")
+            c.fetchall()
+            return True
+        except Exception:
+            self.conn.rollback()
+            return False
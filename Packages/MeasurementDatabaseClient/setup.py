@@ -5,7 +5,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="MeasurementDatabaseClient",
-    version="1.1.4",
+    version="1.2.0",
     author="Dan Narsavage",
     author_email="Dan.Narsavage@idwr.idaho.gov",
     description="Python API for interacting with the MeasurementDatabase database",
@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+import sqlite3
+import time
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip("pyodbc", exc_type=ImportError)
+
+from MeasurementDatabaseClient.DistrictLeaseService import DistrictLeaseService  # noqa: E402
+from MeasurementDatabaseClient.repositories import DistrictLeaseRepository  # noqa: E402
+
+DISTRICTS = ["{:02d}".format(n) for n in range(20)]
+
+
+def _connect(path):
+    return sqlite3.connect(path, timeout=30)
+
+
+def _lease_service(path, owner, lease_seconds=30.0):
+    return DistrictLeaseService(path,
+                                lease_duration=timedelta(seconds=lease_seconds),
+                                heartbeat_interval=timedelta(seconds=lease_seconds / 5),
+                                completed_hold=timedelta(minutes=10),
+                                owner=owner,
+                                connect=_connect)
+
+
+def _import_all(path, owner, results):
+    service = _lease_service(path, owner)
+    for district_number in DISTRICTS:
+        lease = service.try_acquire(district_number)
+        if lease is None:
+            continue
+        with lease:
+            results.put((district_number, owner))
+            time.sleep(0.05)
+
+
+def _acquire_and_crash(path, district_number):
+    _lease_service(path, "crasher", lease_seconds=1.0).try_acquire(district_number)
+    os._exit(1)
+
+
+def test_each_district_is_leased_by_exactly_one_process(tmp_path):
+    path = str(tmp_path / "leases.db")
+    _lease_service(path, "setup").prepare(DISTRICTS)
+    results = multiprocessing.Queue()
+
+    processes = [multiprocessing.Process(target=_import_all, args=(path, "node{}".format(n), results))
+                 for n in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join(60)
+        assert p.exitcode == 0
+
+    holders = {}
+    while len(holders) < len(DISTRICTS) or not results.empty():
+        district_number, owner = results.get(timeout=5)
+        assert district_number not in holders, "{} leased by {} and {}".format(district_number,
+                                                                               holders[district_number], owner)
+        holders[district_number] = owner
+    assert sorted(holders) == DISTRICTS
+
+
+def test_abandoned_lease_is_taken_over_after_it_expires(tmp_path):
+    path = str(tmp_path / "leases.db")
+    _lease_service(path, "setup").prepare(["61"])
+
+    crasher = multiprocessing.Process(target=_acquire_and_crash, args=(path, "61"))
+    crasher.start()
+    crasher.join(30)
+
+    survivor = _lease_service(path, "survivor")
+    assert survivor.try_acquire("61") is None
+
+    time.sleep(1.5)
+    lease = survivor.try_acquire("61")
+    assert lease is not None
+    with survivor.new_repository() as repo:
+        assert repo.get_owner("61") == "survivor"
+    lease.release()
+
+
+def test_lost_lease_is_reported(tmp_path):
+    path = str(tmp_path / "leases.db")
+    holder = _lease_service(path, "slow", lease_seconds=0.5)
+    holder.prepare(["61"])
+    lease = holder.try_acquire("61")
+    with holder.new_repository() as repo:
+        # Simulate another instance taking over after the lease lapsed without a heartbeat
+        repo.release("61", "slow")
+        assert repo.try_acquire("61", "usurper", timedelta(minutes=1))
+    time.sleep(0.5)
+    assert lease.Lost
+    lease.release()
+    with holder.new_repository() as repo:
+        assert repo.get_owner("61") == "usurper"
+
+
+class _FailingConnect:
+    """connect function that fails once the first connection (the one try_acquire uses) has been opened"""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, path):
+        self.calls += 1
+        if self.calls > 1:
+            raise sqlite3.OperationalError("unable to open database file")
+        return _connect(path)
+
+
+def _failing_heartbeat(*args):
+    raise sqlite3.OperationalError("database is locked")
+
+
+@pytest.mark.parametrize("failure", ["connect", "heartbeat"])
+def test_heartbeat_error_counts_as_lost_lease(tmp_path, monkeypatch, failure):
+    path = str(tmp_path / "leases.db")
+    _lease_service(path, "setup").prepare(["61"])
+    holder = _lease_service(path, "flaky", lease_seconds=0.5)
+    if failure == "connect":
+        holder = DistrictLeaseService(path, lease_duration=timedelta(seconds=0.5),
+                                      heartbeat_interval=timedelta(seconds=0.1), owner="flaky",
+                                      connect=_FailingConnect())
+    else:
+        monkeypatch.setattr(DistrictLeaseRepository, "heartbeat", _failing_heartbeat)
+
+    lease = holder.try_acquire("61")
+    assert lease is not None
+    time.sleep(1.0)
+
+    # The lease has expired without renewal, so another instance may take the district; the holder must know
+    usurper_lease = _lease_service(path, "usurper").try_acquire("61")
+    assert usurper_lease is not None
+    assert lease.Lost
+    assert isinstance(lease.Error, sqlite3.OperationalError)
+    lease.release()
+    usurper_lease.release()
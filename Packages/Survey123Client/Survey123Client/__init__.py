@@ -1,18 +1,43 @@
+import logging
+import socket
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 from arcgis.gis import GIS
 
+from Survey123Client.exports import read_export
+from Survey123Client.rawquery import decode_query_response
+from Survey123Client.throttling import ThrottledCaller
+
 
 class Survey123Client:
     """
     Client for downloading data from Survey123 feature services
     """
-    def __init__(self, url: str, username: str, password: str):
-        self.__gis = GIS(
+    def __init__(self, url: str, username: str, password: str, caller: ThrottledCaller = None, gis=None,
+                 timeout=120.0):
+        """
+        :param url: URL of the portal hosting the surveys
+        :param username: Portal user name
+        :param password: Portal password
+        :param caller: ThrottledCaller through which feature service queries are sent.  Defaults to one with the
+                    default rate limit, concurrency limit and retry policy
+        :param gis: Already signed-in GIS to use instead of signing in with url, username and password
+        :param timeout: Seconds to wait on a raw query before giving up on it (and retrying it)
+        """
+        self.__gis = gis or GIS(
             url=url,
             username=username,
             password=password
         )
+        self.__caller = caller or ThrottledCaller(logger=logging.getLogger(__name__))
+        self.__timeout = timeout
 
-    def retrieve_survey_results(self, survey_id: str, field_dict: dict, where_clause='1=1') -> dict:
+    def retrieve_survey_results(self, survey_id: str, field_dict: dict, where_clause='1=1', raw=False) -> dict:
         """
         Retrieve results from one Survey123 feature service.
         :param survey_id: ID of the feature service (typically a GUID, I think)
@@ -20,24 +45,142 @@ class Survey123Client:
                     would rather call those fields
         :param where_clause: where clause to limit returns from the feature service. Omitting this param is equivalent
                     to '1=1'
+        :param raw: True to send the REST query directly and decode the JSON response into rows without building
+                    Feature objects (much faster for large result sets).  Date fields then come back as local
+                    datetime.date values rather than epoch milliseconds
         :return: Dictionary of dictionaries. Outer dictionary is keyed by ObjectID from the feature service and inner
                     dictionaries represent individual features
         """
         survey_results_layer = self.__gis.content.get(survey_id).layers[0]
-        object_id_field = survey_results_layer.properties["objectIdField"]
+        return self.query_layer(survey_results_layer, field_dict, where_clause, raw)
+
+    def query_layer(self, layer, field_dict: dict, where_clause='1=1', raw=False) -> dict:
+        """
+        Retrieve results from a feature layer one page at a time.  The ObjectIDs matching the where clause are fetched
+        first and each page then asks for one range of them, so rows deleted or added mid-download cannot shift the
+        pages and cause others to be skipped (and the layer need not support pagination).  Pages are requested
+        concurrently through this client's ThrottledCaller, so a throttled or failed page is retried on its own.
+        :param layer: FeatureLayer (or anything with the same properties and query method) to query
+        :param field_dict: Dictionary that maps names of feature service fields with what the rest of the application
+                    would rather call those fields
+        :param where_clause: where clause to limit returns from the feature service
+        :param raw: True to bypass Feature objects, as retrieve_survey_results
+        :return: Dictionary of dictionaries, as retrieve_survey_results
+        """
+        object_id_field = layer.properties["objectIdField"]
         fields_to_request = list(field_dict.values())
         fields_to_request.append(object_id_field)
         fields = ",".join(fields_to_request)
         if not where_clause:
             where_clause = '1=1'
-        survey_features = survey_results_layer.query(where=where_clause, out_fields=fields).features
+        try:
+            page_size = layer.properties["maxRecordCount"]
+        except KeyError:
+            page_size = 1000
+
+        id_response = self.__caller.call(
+            lambda: layer.query(where=where_clause, return_ids_only=True),
+            description="ObjectID query")
+        object_ids = sorted(id_response.get("objectIds") or [])
+        id_ranges = [(object_ids[i], object_ids[min(i + page_size, len(object_ids)) - 1])
+                     for i in range(0, len(object_ids), page_size)]
+
+        def query_page(id_range):
+            page_where = "({0}) AND {1} >= {2} AND {1} <= {3}".format(where_clause, object_id_field, *id_range)
+            if raw:
+                return self.__caller.call(
+                    lambda: decode_query_response(
+                        self.__post_query(layer.url, {
+                            "where": page_where,
+                            "outFields": fields,
+                            "returnGeometry": "false",
+                            "f": "json"
+                        }),
+                        field_dict, object_id_field),
+                    description="raw page of ObjectIDs {} to {}".format(*id_range))
+            return self.__caller.call(
+                lambda: layer.query(where=page_where, out_fields=fields, return_geometry=False).features,
+                description="page of ObjectIDs {} to {}".format(*id_range))
+
+        with ThreadPoolExecutor(max_workers=self.__caller.ConcurrencyLimit.Maximum) as executor:
+            pages = list(executor.map(query_page, id_ranges))
 
         return_dict = {}
 
-        for r in survey_features:
-            row_dict = {}
-            for (database_field_name, service_field_name) in field_dict.items():
-                row_dict[database_field_name] = r.get_value(service_field_name)
-            return_dict[r.get_value(object_id_field)] = row_dict
+        if raw:
+            for page in pages:
+                return_dict.update(page)
+            return return_dict
+
+        for survey_features in pages:
+            for r in survey_features:
+                row_dict = {}
+                for (database_field_name, service_field_name) in field_dict.items():
+                    row_dict[database_field_name] = r.get_value(service_field_name)
+                return_dict[r.get_value(object_id_field)] = row_dict
 
         return return_dict
+
+    def export_survey_results(self, survey_id: str, field_dict: dict, date_fields=(), export_format="CSV",
+                              save_path=None, numeric_fields=(), layer=None) -> dict:
+        """
+        Retrieve every result from one Survey123 feature service by having ArcGIS Online export the service to a file,
+        downloading the file and streaming it.  Much faster than paging through queries for season-start loads and
+        full re-syncs.  The export item is deleted from the portal once it has been downloaded.  Only the download is
+        retried; retrying the export itself could leave export items behind in the portal that nothing deletes.
+        :param survey_id: ID of the feature service
+        :param field_dict: Dictionary that maps names of feature service fields with what the rest of the application
+                    would rather call those fields
+        :param date_fields: Names of feature service fields holding dates; these come back as local datetime.date values
+        :param export_format: Export format understood by both ArcGIS Online and read_export ("CSV", "GeoJson" or
+                    "File Geodatabase")
+        :param save_path: Folder to keep the downloaded export in.  If omitted the export is downloaded to a temporary
+                    folder and removed after it has been read
+        :param numeric_fields: Names of feature service fields holding numbers, as read_export
+        :param layer: Name or index of the layer to read if the export holds more than one, as read_export
+        :return: Dictionary of dictionaries keyed by ObjectID, as retrieve_survey_results
+        """
+        survey_item = self.__gis.content.get(survey_id)
+        export_item = survey_item.export("{}_export".format(survey_item.title), export_format, wait=True)
+        try:
+            if save_path is not None:
+                path = self.__caller.call(lambda: export_item.download(save_path=save_path),
+                                          description="download of {}".format(survey_id))
+                return read_export(path, field_dict, date_fields, numeric_fields=numeric_fields, layer=layer)
+            with tempfile.TemporaryDirectory() as temp_dir:
+                path = self.__caller.call(lambda: export_item.download(save_path=temp_dir),
+                                          description="download of {}".format(survey_id))
+                return read_export(path, field_dict, date_fields, numeric_fields=numeric_fields, layer=layer)
+        finally:
+            export_item.delete()
+
+    def __post_query(self, layer_url: str, params: dict) -> bytes:
+        """
+        Posts a query to a feature layer's REST endpoint through the GIS connection and returns the undecoded body.
+        A query that stalls raises TimeoutError after this client's timeout so the ThrottledCaller can retry it.
+        :param layer_url: URL of the feature layer
+        :param params: Query parameters
+        :return: Body of the response
+        """
+        connection = self.__gis._con
+        token = getattr(connection, "token", None)
+        if token:
+            params["token"] = token
+        url = layer_url + "/query"
+        session = getattr(connection, "_session", None)
+        if session is not None:
+            # requests-based connections carry the portal's proxy, certificate and authentication settings
+            try:
+                response = session.post(url, data=params, timeout=self.__timeout)
+            except requests.Timeout as e:
+                raise TimeoutError("Query to {} timed out".format(layer_url)) from e
+            response.raise_for_status()
+            return response.content
+        request = urllib.request.Request(url, data=urllib.parse.urlencode(params).encode("utf-8"))
+        try:
+            with urllib.request.urlopen(request, timeout=self.__timeout) as response:
+                return response.read()
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                raise TimeoutError("Query to {} timed out".format(layer_url)) from e
+            raise
@@ -0,0 +1,7 @@
+class FeatureServiceError(Exception):
+    """Exception raised when a feature service responds to a request with an error instead of results"""
+
+    def __init__(self, code, message, *errors):
+        super(FeatureServiceError, self).__init__("Error {0}: {1}".format(code, message))
+        self.code = code
+        self.errors = errors
@@ -0,0 +1,168 @@
+import csv
+import datetime
+import io
+import json
+import os
+import zipfile
+
+from dateutil import parser as date_parser
+from dateutil.tz import tzlocal, tzutc
+
+_object_id_fields = ("ObjectID", "OBJECTID", "objectid", "FID")
+
+
+def read_export(path: str, field_dict: dict, date_fields=(), object_id_field=None, numeric_fields=(),
+                layer=None) -> dict:
+    """
+    Reads a feature service export (as downloaded from ArcGIS Online) into the same shape
+    Survey123Client.retrieve_survey_results returns.  CSV, GeoJSON and file geodatabase exports are supported, either
+    as files or zipped as ArcGIS Online delivers them; file geodatabases need the optional fiona package.
+    :param path: Path of the export file (.csv, .geojson, .json, .gdb, or a .zip holding one of those)
+    :param field_dict: Dictionary that maps names of feature service fields with what the rest of the application
+                would rather call those fields
+    :param date_fields: Names of feature service fields holding dates; these are converted to local datetime.date values
+    :param object_id_field: Name of the ObjectID field.  If omitted the usual names (ObjectID, OBJECTID, FID) are tried.
+                A ValueError is raised if a feature has no ObjectID, rather than rows overwriting each other
+    :param numeric_fields: Names of feature service fields holding numbers.  CSV exports hold every value as text, so
+                only these are converted back to numbers; every other field is left as text
+    :param layer: Name or index of the layer to read when the export holds more than one (several files in a zip, or
+                several feature classes in a file geodatabase)
+    :return: Dictionary of dictionaries keyed by ObjectID
+    """
+    return dict(iter_export(path, field_dict, date_fields, object_id_field, numeric_fields, layer))
+
+
+def iter_export(path: str, field_dict: dict, date_fields=(), object_id_field=None, numeric_fields=(), layer=None):
+    """
+    Streams a feature service export one feature at a time.  Parameters are as read_export.
+    :return: Generator of (ObjectID, row dictionary) tuples
+    """
+    for attributes, feature_id in _iter_features(path, layer):
+        object_id = _find_object_id(attributes, object_id_field)
+        if object_id is None:
+            object_id = feature_id
+        if object_id is None:
+            raise ValueError("Export '{}' has a feature without an ObjectID; tried {}".format(
+                path, object_id_field or ", ".join(_object_id_fields)))
+        if isinstance(object_id, str):
+            object_id = int(object_id)
+        row_dict = {}
+        for (database_field_name, service_field_name) in field_dict.items():
+            value = attributes.get(service_field_name)
+            if service_field_name in date_fields:
+                value = _to_local_date(value)
+            elif service_field_name in numeric_fields and isinstance(value, str):
+                value = _parse_number(value)
+            row_dict[database_field_name] = value
+        yield object_id, row_dict
+
+
+def _iter_features(path: str, layer=None):
+    """
+    Yields (attributes, feature ID or None) for every feature in an export
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            names = sorted(archive.namelist())
+            csv_names = [n for n in names if n.lower().endswith(".csv")]
+            geojson_names = [n for n in names if n.lower().endswith((".geojson", ".json"))]
+            if csv_names:
+                with archive.open(_choose_layer(path, csv_names, layer)) as f:
+                    yield from _iter_csv(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+            elif geojson_names:
+                with archive.open(_choose_layer(path, geojson_names, layer)) as f:
+                    yield from _iter_geojson(f)
+            else:
+                yield from _iter_geodatabase("zip://" + os.path.abspath(path), layer)
+    elif extension == ".csv":
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            yield from _iter_csv(f)
+    elif extension in (".geojson", ".json"):
+        with open(path, "rb") as f:
+            yield from _iter_geojson(f)
+    elif extension == ".gdb":
+        yield from _iter_geodatabase(path, layer)
+    else:
+        raise ValueError("Unsupported export file type '{}'".format(extension))
+
+
+def _iter_csv(f):
+    for record in csv.DictReader(f):
+        yield {name: None if value == "" else value for name, value in record.items()}, None
+
+
+def _iter_geojson(f):
+    try:
+        import ijson
+    except ImportError:
+        features = json.load(f)["features"]
+    else:
+        # Streams features without loading the whole file
+        features = ijson.items(f, "features.item", use_float=True)
+    for feature in features:
+        yield feature.get("properties") or {}, feature.get("id")
+
+
+def _iter_geodatabase(path: str, layer=None):
+    try:
+        import fiona
+    except ImportError:
+        raise ImportError("Reading file geodatabase exports requires the fiona package")
+    layer_name = _choose_layer(path, fiona.listlayers(path), layer)
+    with fiona.open(path, layer=layer_name) as features:
+        for feature in features:
+            yield dict(feature["properties"]), feature.get("id")
+
+
+def _choose_layer(path: str, layer_names: list, layer):
+    """
+    Picks one layer out of an export by name (with or without its file extension) or by index.  An export holding
+    several layers must say which one is wanted rather than silently reading whichever sorts first.
+    """
+    if layer is None:
+        if len(layer_names) != 1:
+            raise ValueError("Export '{}' holds {} layers ({}); choose one with the layer parameter".format(
+                path, len(layer_names), ", ".join(layer_names)))
+        return layer_names[0]
+    if isinstance(layer, int):
+        return layer_names[layer]
+    for name in layer_names:
+        if layer.lower() in (name.lower(), os.path.splitext(os.path.basename(name))[0].lower()):
+            return name
+    raise ValueError("Export '{}' has no layer '{}'; it holds {}".format(path, layer, ", ".join(layer_names)))
+
+
+def _find_object_id(attributes: dict, object_id_field):
+    if object_id_field is not None:
+        return attributes.get(object_id_field)
+    for name in _object_id_fields:
+        if attributes.get(name) is not None:
+            return attributes[name]
+    return None
+
+
+def _parse_number(value: str):
+    """
+    Turns a numeric field's text, as CSV exports write it, back into a number
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _to_local_date(value):
+    """
+    Converts an exported date (epoch milliseconds, or text as CSV and GeoJSON exports write it) to a local date.
+    Exports hold dates in UTC.
+    """
+    if value is None or isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value / 1e3).date()
+    if not isinstance(value, datetime.datetime):
+        value = date_parser.parse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tzutc())
+    return value.astimezone(tzlocal()).date()
@@ -0,0 +1,54 @@
+import pandas
+from dateutil.tz import tzlocal
+
+from Survey123Client.exceptions import FeatureServiceError
+
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        from json import loads
+
+
+def decode_query_response(body: bytes, field_dict: dict, object_id_field: str) -> dict:
+    """
+    Decodes the raw JSON body of a feature service query straight into mapped rows, without building Feature objects.
+    Fields the response describes as dates are converted from epoch milliseconds to local dates all at once.
+    :param body: Body of the query response (f=json)
+    :param field_dict: Dictionary that maps names of feature service fields with what the rest of the application
+                would rather call those fields
+    :param object_id_field: Name of the feature service's ObjectID field
+    :return: Dictionary of dictionaries keyed by ObjectID, as Survey123Client.retrieve_survey_results
+    """
+    response = loads(body)
+    if "error" in response:
+        error = response["error"]
+        raise FeatureServiceError(error.get("code"), error.get("message"), *error.get("details", []))
+
+    date_fields = {f["name"] for f in response.get("fields", []) if f.get("type") == "esriFieldTypeDate"}
+    attributes = [f["attributes"] for f in response["features"]]
+
+    columns = []
+    for service_field_name in field_dict.values():
+        column = [a.get(service_field_name) for a in attributes]
+        if service_field_name in date_fields:
+            column = epoch_ms_to_dates(column)
+        columns.append(column)
+
+    database_field_names = list(field_dict.keys())
+    object_ids = [a[object_id_field] for a in attributes]
+    return {object_id: dict(zip(database_field_names, values))
+            for object_id, *values in zip(object_ids, *columns)}
+
+
+def epoch_ms_to_dates(values: list) -> list:
+    """
+    Converts epoch-millisecond timestamps to dates in the local time zone (as datetime.fromtimestamp would)
+    :param values: Timestamps in milliseconds since the epoch; None is allowed
+    :return: list of datetime.date, with None wherever the input was None
+    """
+    timestamps = pandas.to_datetime(pandas.Series(values, dtype="float64"), unit="ms", utc=True)
+    local_dates = timestamps.dt.tz_convert(tzlocal()).dt.date
+    return local_dates.astype(object).where(timestamps.notna(), None).tolist()
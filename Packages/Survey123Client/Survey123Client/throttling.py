@@ -0,0 +1,223 @@
+import random
+import re
+import socket
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.  Tokens refill at Rate per second up to Capacity; each request takes one token.
+    The rate adapts: it is halved whenever the service throttles us and creeps back up while requests succeed.
+    """
+    def __init__(self, rate=5.0, capacity=10, min_rate=0.2, max_rate=None, sleep=time.sleep):
+        """
+        :param rate: Starting number of requests per second
+        :param capacity: Largest burst allowed after a quiet period
+        :param min_rate: Rate will never be slowed below this many requests per second
+        :param max_rate: Rate will never be sped up beyond this many requests per second (defaults to the starting rate)
+        :param sleep: Function used to wait for tokens (replaceable for testing)
+        """
+        self.Rate = float(rate)
+        self.Capacity = capacity
+        self.MinRate = min_rate
+        self.MaxRate = float(max_rate or rate)
+        self.__tokens = float(capacity)
+        self.__last_refill = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__sleep = sleep
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        :return: Nothing
+        """
+        while True:
+            with self.__lock:
+                self.__refill()
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.Rate
+            self.__sleep(wait)
+
+    def slow_down(self):
+        """
+        Halves the rate and empties the bucket so the next request waits for a fresh token
+        :return: Nothing
+        """
+        with self.__lock:
+            self.__refill()
+            self.Rate = max(self.MinRate, self.Rate / 2)
+            self.__tokens = min(self.__tokens, 0)
+
+    def speed_up(self):
+        """
+        Nudges the rate back up after a successful request
+        :return: Nothing
+        """
+        with self.__lock:
+            self.Rate = min(self.MaxRate, self.Rate + 0.1)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.Capacity, self.__tokens + (now - self.__last_refill) * self.Rate)
+        self.__last_refill = now
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limits how many requests may be in flight at once, adjusting the limit from observed latency and errors
+    (additive increase, multiplicative decrease).  The limit grows by one per round of fast successes, and shrinks when
+    latency rises well above the best latency seen or when a request fails.
+    """
+    def __init__(self, initial=2, minimum=1, maximum=8, latency_tolerance=2.0):
+        """
+        :param initial: Starting number of concurrent requests
+        :param minimum: Fewest concurrent requests allowed
+        :param maximum: Most concurrent requests allowed
+        :param latency_tolerance: Latency above this multiple of the best observed latency counts as congestion
+        """
+        self.Limit = float(initial)
+        self.Minimum = minimum
+        self.Maximum = maximum
+        self.LatencyTolerance = latency_tolerance
+        self.__best_latency = None
+        self.__in_flight = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until another request may be sent
+        :return: Nothing
+        """
+        with self.__condition:
+            while self.__in_flight >= int(self.Limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+
+    def release(self, latency=None, failed=False):
+        """
+        Records the outcome of a request and frees its slot
+        :param latency: Seconds the request took (ignored if it failed)
+        :param failed: True if the request was throttled or failed
+        :return: Nothing
+        """
+        with self.__condition:
+            self.__in_flight -= 1
+            if failed:
+                self.Limit = max(self.Minimum, self.Limit / 2)
+            else:
+                if self.__best_latency is None or latency < self.__best_latency:
+                    self.__best_latency = latency
+                if latency > self.__best_latency * self.LatencyTolerance:
+                    self.Limit = max(self.Minimum, self.Limit * 0.9)
+                else:
+                    self.Limit = min(self.Maximum, self.Limit + 1 / self.Limit)
+            self.__condition.notify_all()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for requests that were throttled or failed transiently
+    """
+    __retryable_status_codes = (429, 500, 502, 503, 504)
+    # Only consulted for errors that carry no status code (e.g. arcgis exceptions, which only have a message)
+    __throttle_pattern = re.compile(r"\b429\b|too many requests|rate limit|throttl", re.IGNORECASE)
+    __transient_pattern = re.compile(r"\b50[0234]\b|timed? ?out|temporarily|service unavailable|bad gateway|"
+                                     r"connection (aborted|reset|refused)", re.IGNORECASE)
+
+    def __init__(self, max_attempts=6, base_delay=1.0, max_delay=60.0):
+        """
+        :param max_attempts: Total tries per request, including the first
+        :param base_delay: Backoff ceiling in seconds after the first failure; doubles after each further failure
+        :param max_delay: Largest backoff ceiling in seconds
+        """
+        self.MaxAttempts = max_attempts
+        self.BaseDelay = base_delay
+        self.MaxDelay = max_delay
+
+    @staticmethod
+    def status_code(error: Exception):
+        """
+        HTTP or feature service status code carried by an error, if any
+        :return: int, or None if the error has no status code
+        """
+        code = getattr(error, "code", None)
+        if code is None:
+            code = getattr(getattr(error, "response", None), "status_code", None)
+        try:
+            return int(code)
+        except (TypeError, ValueError):
+            return None
+
+    def is_throttled(self, error: Exception):
+        """
+        Whether an error means the service is throttling us
+        """
+        code = self.status_code(error)
+        if code is not None:
+            return code == 429
+        return bool(self.__throttle_pattern.search(str(error)))
+
+    def is_retryable(self, error: Exception):
+        """
+        Whether an error is worth retrying (throttling, timeouts, dropped connections and 5xx responses).  Anything
+        else, such as a 400 for a bad where clause, fails straight away.
+        """
+        if isinstance(error, (ConnectionError, TimeoutError, socket.timeout)):
+            return True
+        code = self.status_code(error)
+        if code is not None:
+            return code in self.__retryable_status_codes
+        return self.is_throttled(error) or bool(self.__transient_pattern.search(str(error)))
+
+    def backoff(self, attempt: int):
+        """
+        Seconds to wait before the next try
+        :param attempt: Number of tries made so far (1 after the first failure)
+        """
+        return random.uniform(0, min(self.MaxDelay, self.BaseDelay * 2 ** (attempt - 1)))
+
+
+class ThrottledCaller:
+    """
+    Sends requests through a TokenBucket and an AdaptiveConcurrencyLimit, retrying per the RetryPolicy
+    """
+    def __init__(self, rate_limiter=None, concurrency_limit=None, retry_policy=None, logger=None, sleep=time.sleep):
+        self.RateLimiter = rate_limiter or TokenBucket()
+        self.ConcurrencyLimit = concurrency_limit or AdaptiveConcurrencyLimit()
+        self.RetryPolicy = retry_policy or RetryPolicy()
+        self.__logger = logger
+        self.__sleep = sleep
+
+    def call(self, request, description="request"):
+        """
+        Calls request() until it succeeds, a non-retryable error is raised, or the retry policy gives up
+        :param request: Function taking no arguments that performs one request
+        :param description: Text describing the request for log messages
+        :return: Whatever request() returns
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.RateLimiter.acquire()
+            self.ConcurrencyLimit.acquire()
+            started = time.monotonic()
+            try:
+                result = request()
+            except Exception as e:
+                self.ConcurrencyLimit.release(failed=True)
+                if not self.RetryPolicy.is_retryable(e) or attempt >= self.RetryPolicy.MaxAttempts:
+                    raise
+                if self.RetryPolicy.is_throttled(e):
+                    self.RateLimiter.slow_down()
+                delay = self.RetryPolicy.backoff(attempt)
+                if self.__logger is not None:
+                    self.__logger.warning("Attempt {} of {} failed ({}); retrying in {:.1f}s"
+                                          .format(attempt, description, e, delay))
+                self.__sleep(delay)
+                continue
+            self.ConcurrencyLimit.release(latency=time.monotonic() - started)
+            self.RateLimiter.speed_up()
+            return result
@@ -0,0 +1,363 @@
+import hmac
+import json
+import logging
+import sqlite3
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class WebhookQueue:
+    """
+    Durable first-in-first-out queue of mapped survey submissions, kept in a sqlite3 file so that submissions which
+    have been acknowledged to Survey123 survive a restart until they are imported.  Submissions that keep failing to
+    import are moved to a DeadSubmission table in the same file so they cannot hold up the rest of the queue.
+    """
+    def __init__(self, path: str):
+        """
+        :param path: Path of the sqlite3 file holding the queue (created if missing)
+        """
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS [QueuedSubmission] ('
+                            '     [ID] INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            '     [DistrictNumber] TEXT NOT NULL, '
+                            '     [ObjectId] TEXT NOT NULL, '
+                            '     [Row] TEXT NOT NULL, '
+                            '     [ReceivedAt] REAL NOT NULL, '
+                            '     [Attempts] INTEGER NOT NULL DEFAULT 0)')
+        columns = [c[1] for c in self.__conn.execute('PRAGMA table_info([QueuedSubmission])')]
+        if "Attempts" not in columns:
+            # Queue files created before failed submissions were counted
+            self.__conn.execute('ALTER TABLE [QueuedSubmission] ADD COLUMN [Attempts] INTEGER NOT NULL DEFAULT 0')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS [DeadSubmission] ('
+                            '     [ID] INTEGER PRIMARY KEY, '
+                            '     [DistrictNumber] TEXT NOT NULL, '
+                            '     [ObjectId] TEXT NOT NULL, '
+                            '     [Row] TEXT NOT NULL, '
+                            '     [ReceivedAt] REAL NOT NULL, '
+                            '     [FailedAt] REAL NOT NULL, '
+                            '     [Error] TEXT NULL)')
+        self.__conn.commit()
+
+    def put(self, district_number: str, object_id, row: dict):
+        """
+        Adds one submission to the queue and commits it
+        :param district_number: Water district the submission belongs to
+        :param object_id: ObjectID of the submitted feature
+        :param row: Mapped submission
+        :return: Nothing
+        """
+        with self.__lock:
+            self.__conn.execute('INSERT INTO [QueuedSubmission] ([DistrictNumber], [ObjectId], [Row], [ReceivedAt]) '
+                                'VALUES (?, ?, ?, ?)',
+                                (district_number, json.dumps(object_id), json.dumps(row), time.time()))
+            self.__conn.commit()
+
+    def count(self):
+        """
+        :return: Number of submissions waiting in the queue
+        """
+        with self.__lock:
+            return self.__conn.execute('SELECT COUNT(*) FROM [QueuedSubmission]').fetchone()[0]
+
+    def dead_count(self):
+        """
+        :return: Number of submissions that were given up on
+        """
+        with self.__lock:
+            return self.__conn.execute('SELECT COUNT(*) FROM [DeadSubmission]').fetchone()[0]
+
+    def oldest_received_at(self):
+        """
+        :return: Time (as time.time()) the oldest waiting submission was received, or None if the queue is empty
+        """
+        with self.__lock:
+            return self.__conn.execute('SELECT MIN([ReceivedAt]) FROM [QueuedSubmission]').fetchone()[0]
+
+    def peek(self, limit: int):
+        """
+        Gets the oldest waiting submissions grouped by district, without removing them
+        :param limit: Most submissions to return
+        :return: Dictionary keyed by district number of lists of (queue ID, ObjectID, row dictionary) tuples
+        """
+        with self.__lock:
+            rows = self.__conn.execute('SELECT [ID], [DistrictNumber], [ObjectId], [Row] FROM [QueuedSubmission] '
+                                       'ORDER BY [ID] LIMIT ?', (limit,)).fetchall()
+        by_district = {}
+        for queue_id, district_number, object_id, row in rows:
+            by_district.setdefault(district_number, []).append((queue_id, json.loads(object_id), json.loads(row)))
+        return by_district
+
+    def remove(self, ids: list):
+        """
+        Removes submissions from the queue once they have been imported
+        :param ids: Queue IDs returned by peek
+        :return: Nothing
+        """
+        with self.__lock:
+            self.__conn.executemany('DELETE FROM [QueuedSubmission] WHERE [ID]=?', [(i,) for i in ids])
+            self.__conn.commit()
+
+    def record_failure(self, queue_id: int, error: str, max_attempts: int):
+        """
+        Counts a failed attempt to import a submission, moving it to the DeadSubmission table once it has failed
+        max_attempts times
+        :param queue_id: Queue ID returned by peek
+        :param error: Description of the failure
+        :param max_attempts: Number of failures after which the submission is given up on
+        :return: True if the submission was moved to the DeadSubmission table
+        """
+        with self.__lock:
+            self.__conn.execute('UPDATE [QueuedSubmission] SET [Attempts]=[Attempts] + 1 WHERE [ID]=?', (queue_id,))
+            moved = self.__conn.execute('INSERT INTO [DeadSubmission] '
+                                        '     ([ID], [DistrictNumber], [ObjectId], [Row], [ReceivedAt], [FailedAt], '
+                                        '      [Error]) '
+                                        'SELECT [ID], [DistrictNumber], [ObjectId], [Row], [ReceivedAt], ?, ? '
+                                        'FROM [QueuedSubmission] WHERE [ID]=? AND [Attempts] >= ?',
+                                        (time.time(), error, queue_id, max_attempts)).rowcount == 1
+            if moved:
+                self.__conn.execute('DELETE FROM [QueuedSubmission] WHERE [ID]=?', (queue_id,))
+            self.__conn.commit()
+        return moved
+
+    def requeue_dead(self):
+        """
+        Puts every given-up submission back on the queue (e.g. after the cause of the failures has been fixed)
+        :return: Number of submissions requeued
+        """
+        with self.__lock:
+            requeued = self.__conn.execute('INSERT INTO [QueuedSubmission] '
+                                           '     ([DistrictNumber], [ObjectId], [Row], [ReceivedAt]) '
+                                           'SELECT [DistrictNumber], [ObjectId], [Row], [ReceivedAt] '
+                                           'FROM [DeadSubmission] ORDER BY [ID]').rowcount
+            self.__conn.execute('DELETE FROM [DeadSubmission]')
+            self.__conn.commit()
+        return requeued
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+
+def map_webhook_payload(payload: dict, field_dict: dict):
+    """
+    Maps the feature in a Survey123 webhook payload into the same row shape Survey123Client.retrieve_survey_results
+    returns
+    :param payload: Decoded webhook body
+    :param field_dict: Dictionary that maps names of feature service fields with what the rest of the application
+                would rather call those fields
+    :return: Tuple of (ObjectID, row dictionary)
+    """
+    feature = payload["feature"]
+    attributes = feature["attributes"]
+    result = feature.get("result") or {}
+    object_id = result.get("objectId")
+    if object_id is None:
+        object_id = attributes.get("objectid", attributes.get("OBJECTID"))
+    if object_id is None:
+        raise ValueError("Payload has no ObjectID (feature.result.objectId or an objectid attribute)")
+    row = {database_field_name: attributes.get(service_field_name)
+           for database_field_name, service_field_name in field_dict.items()}
+    return object_id, row
+
+
+class WebhookReceiver(ThreadingMixIn, HTTPServer):
+    """
+    Small HTTP server that accepts Survey123 webhook posts at /<district number>?token=<secret>, puts each submission
+    on a WebhookQueue and acknowledges it.  A background thread hands queued submissions to a flush function in
+    micro-batches, whenever BatchSize submissions are waiting or the oldest has waited BatchSeconds.  If a batch fails
+    its submissions are imported one at a time so a bad one cannot hold back the others; a submission that fails
+    MaxAttempts times while others import is moved to the queue's DeadSubmission table.  When nothing can be imported
+    (e.g. the database is down) no attempts are counted and the receiver backs off, up to MaxBackoffSeconds, until
+    imports succeed again.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple, queue: WebhookQueue, surveys: dict, flush, secret: str, validate=None,
+                 batch_size=100, batch_seconds=30.0, max_attempts=5, max_backoff_seconds=600.0, logger=None):
+        """
+        :param address: (host, port) to listen on
+        :param queue: WebhookQueue submissions are held in until imported
+        :param surveys: Dictionary keyed by district number of the field_dict used to map that district's submissions
+        :param flush: Function taking (district number, dictionary of rows keyed by ObjectID) that imports a batch.
+                    If it raises, the batch stays queued and is tried again later
+        :param secret: Shared secret that every post must carry, either as the "token" query string parameter or the
+                    X-Webhook-Token header
+        :param validate: Optional function taking (district number, row dictionary) that raises ValueError if the row
+                    cannot be imported.  Such posts are refused with a 400 instead of being queued
+        :param batch_size: Number of waiting submissions that triggers a flush
+        :param batch_seconds: Longest a submission waits before being flushed
+        :param max_attempts: Number of failed imports after which a submission is given up on.  Only failures while
+                    other submissions in the same batch import are counted
+        :param max_backoff_seconds: Longest wait between retries while every import is failing
+        :param logger: Logger
+        """
+        if not secret:
+            raise ValueError("A shared secret is required so that only Survey123 can post submissions")
+        super(WebhookReceiver, self).__init__(address, _WebhookRequestHandler)
+        self.Queue = queue
+        self.Surveys = surveys
+        self.Secret = secret
+        self.BatchSize = batch_size
+        self.BatchSeconds = batch_seconds
+        self.MaxAttempts = max_attempts
+        self.MaxBackoffSeconds = max_backoff_seconds
+        self.logger = logger or logging.getLogger(__name__)
+        self.__flush = flush
+        self.__validate = validate
+        self.__wake = threading.Event()
+        self.__stopping = threading.Event()
+        self.__flusher = threading.Thread(target=self.__flush_loop, name="WebhookFlusher", daemon=True)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.__flusher.start()
+        try:
+            super(WebhookReceiver, self).serve_forever(poll_interval)
+        finally:
+            self.__stopping.set()
+            self.__wake.set()
+            self.__flusher.join()
+
+    def validate(self, district_number: str, row: dict):
+        """
+        Raises ValueError if a submission should not be queued
+        """
+        if self.__validate is not None:
+            self.__validate(district_number, row)
+
+    def submitted(self):
+        """
+        Called by the request handler after a submission is queued; wakes the flusher if a batch is full
+        """
+        if self.Queue.count() >= self.BatchSize:
+            self.__wake.set()
+
+    def flush_waiting(self):
+        """
+        Imports everything waiting in the queue, one batch at a time
+        :return: True if the queue was emptied, False if a submission failed and is waiting to be retried
+        """
+        while True:
+            by_district = self.Queue.peek(self.BatchSize)
+            if not by_district:
+                return True
+            all_imported = True
+            for district_number, submissions in by_district.items():
+                all_imported = self.__flush_district(district_number, submissions) and all_imported
+            if not all_imported:
+                return False
+
+    def __flush_district(self, district_number: str, submissions: list):
+        """
+        Imports one district's share of a batch, falling back to one submission at a time if the batch fails.
+        Failures only count against a submission when others import, since when every one fails the cause is more
+        likely the database than the submissions.
+        :return: True if every submission was imported
+        """
+        # Batches are keyed by ObjectID, so a feature submitted more than once waits for the next batch rather than
+        # being overwritten (and removed from the queue without being imported)
+        batch = {}
+        for submission in submissions:
+            batch.setdefault(submission[1], submission)
+        submissions = list(batch.values())
+
+        try:
+            self.__flush(district_number, {object_id: row for _, object_id, row in submissions})
+            self.Queue.remove([queue_id for queue_id, _, _ in submissions])
+            return True
+        except Exception as e:
+            if len(submissions) == 1:
+                self.logger.exception(msg="Unable to import webhook submission {} for '{}'; it stays queued"
+                                      .format(submissions[0][1], district_number), exc_info=e)
+                return False
+            self.logger.warning("Batch of {} webhook submissions for '{}' failed ({}); importing them one at a time"
+                                .format(len(submissions), district_number, e))
+
+        failures = []
+        for submission in submissions:
+            queue_id, object_id, row = submission
+            try:
+                self.__flush(district_number, {object_id: row})
+                self.Queue.remove([queue_id])
+            except Exception as e:
+                failures.append((submission, e))
+        if len(failures) == len(submissions):
+            self.logger.exception(msg="Unable to import any of {} webhook submissions for '{}'; they stay queued"
+                                  .format(len(submissions), district_number), exc_info=failures[-1][1])
+            return False
+        for submission, e in failures:
+            self.__record_failure(district_number, submission, e)
+        return not failures
+
+    def __record_failure(self, district_number: str, submission: tuple, error: Exception):
+        queue_id, object_id, row = submission
+        if self.Queue.record_failure(queue_id, repr(error), self.MaxAttempts):
+            self.logger.error("Gave up importing webhook submission {} for '{}' after {} attempts: {!r} ({})"
+                              .format(object_id, district_number, self.MaxAttempts, error, row))
+        else:
+            self.logger.exception(msg="Unable to import webhook submission {} for '{}'"
+                                  .format(object_id, district_number), exc_info=error)
+
+    def __flush_loop(self):
+        failed_rounds = 0
+        while not self.__stopping.is_set():
+            oldest = self.Queue.oldest_received_at()
+            timeout = self.BatchSeconds if oldest is None else max(0.0, oldest + self.BatchSeconds - time.time())
+            self.__wake.wait(timeout)
+            self.__wake.clear()
+            if self.Queue.count() == 0:
+                continue
+            if self.flush_waiting():
+                failed_rounds = 0
+            else:
+                # Give whatever failed a moment before trying again, backing off further while failures continue
+                failed_rounds += 1
+                self.__stopping.wait(min(self.BatchSeconds * 2 ** min(failed_rounds - 1, 16), self.MaxBackoffSeconds))
+        self.flush_waiting()
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles webhook posts for WebhookReceiver
+    """
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        token = urllib.parse.parse_qs(url.query).get("token", [None])[0] or self.headers.get("X-Webhook-Token")
+        if token is None or not hmac.compare_digest(token.encode("utf-8"), self.server.Secret.encode("utf-8")):
+            self.__respond(403, "Missing or incorrect token")
+            return
+        district_number = url.path.strip("/").split("/")[-1]
+        field_dict = self.server.Surveys.get(district_number)
+        if field_dict is None:
+            self.__respond(404, "No survey configured for '{}'".format(district_number))
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            payload = json.loads(body.decode("utf-8"))
+            object_id, row = map_webhook_payload(payload, field_dict)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.__respond(400, "Unreadable webhook payload: {}".format(e))
+            return
+        try:
+            self.server.validate(district_number, row)
+        except ValueError as e:
+            self.server.logger.error("Refused webhook submission {} for '{}': {}".format(object_id, district_number, e))
+            self.__respond(400, "Invalid submission: {}".format(e))
+            return
+        self.server.Queue.put(district_number, object_id, row)
+        self.server.submitted()
+        self.__respond(200, "Queued")
+
+    def log_message(self, format_, *args):
+        self.server.logger.debug("%s - %s", self.address_string(), format_ % args)
+
+    def __respond(self, status: int, message: str):
+        body = json.dumps({"message": message}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
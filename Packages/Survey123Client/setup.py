@@ -5,7 +5,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="Survey123Client",
-    version="1.1.0",
+    version="1.5.0",
     author="Dan Narsavage",
     author_email="Dan.Narsavage@idwr.idaho.gov",
     description="Python API for interacting with Esri Survey123",
@@ -17,6 +17,9 @@ setuptools.setup(
     ],
 	install_requires=[
           'arcgis>=1.6.1',
+          'pandas',
+          'requests',
+          'python-dateutil>=2.8.0',
 	],
 	python_requires='>=3.6',
 )
@@ -0,0 +1,161 @@
+import datetime
+import os
+import shutil
+import zipfile
+
+import pytest
+
+from Survey123Client import Survey123Client
+from Survey123Client.exports import read_export
+from Survey123Client.throttling import RetryPolicy, ThrottledCaller, TokenBucket
+
+DATA = os.path.join(os.path.dirname(__file__), "data")
+CSV_EXPORT = os.path.join(DATA, "export.csv")
+GEOJSON_EXPORT = os.path.join(DATA, "export.geojson")
+
+FIELDS = {
+    "LocationID": "LocationID",
+    "MeasurementTypeId": "MeasurementType",
+    "Discharge": "Total_CFS_Today",
+    "DiversionDate": "DateOfVisit",
+    "UserId": "PersonDoingSurvey",
+    "DeviceType": "Diversion_Type"
+}
+DATE_FIELDS = ["DateOfVisit"]
+NUMERIC_FIELDS = ["LocationID", "MeasurementType", "Total_CFS_Today"]
+
+
+def local_date(*utc):
+    return datetime.datetime(*utc, tzinfo=datetime.timezone.utc).astimezone().date()
+
+
+EXPECTED = {
+    1: {"LocationID": 10437, "MeasurementTypeId": 1, "Discharge": 12.5,
+        "DiversionDate": local_date(2025, 10, 19, 19, 33, 20), "UserId": "0123", "DeviceType": "Open Channel"},
+    2: {"LocationID": 10438, "MeasurementTypeId": None, "Discharge": 3,
+        "DiversionDate": local_date(2025, 10, 20, 4, 15), "UserId": "nan", "DeviceType": "Infinity"},
+    3: {"LocationID": 10439, "MeasurementTypeId": 2, "Discharge": None, "DiversionDate": None,
+        "UserId": None, "DeviceType": None},
+}
+
+
+def zip_export(tmp_path, *members):
+    path = str(tmp_path / "export.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, source in members:
+            archive.write(source, name)
+    return path
+
+
+@pytest.mark.parametrize("path", [CSV_EXPORT, GEOJSON_EXPORT])
+def test_read_export(path):
+    assert read_export(path, FIELDS, DATE_FIELDS, numeric_fields=NUMERIC_FIELDS) == EXPECTED
+
+
+def test_csv_text_fields_are_left_as_text():
+    rows = read_export(CSV_EXPORT, FIELDS, DATE_FIELDS)
+
+    assert rows[1]["UserId"] == "0123"
+    assert rows[2]["UserId"] == "nan"
+    assert rows[2]["DeviceType"] == "Infinity"
+    # Without numeric_fields even numbers stay as the export wrote them
+    assert rows[1]["Discharge"] == "12.5"
+
+
+@pytest.mark.parametrize("member, source", [("export.csv", CSV_EXPORT), ("export.geojson", GEOJSON_EXPORT)])
+def test_read_zipped_export(tmp_path, member, source):
+    path = zip_export(tmp_path, (member, source))
+
+    assert read_export(path, FIELDS, DATE_FIELDS, numeric_fields=NUMERIC_FIELDS) == EXPECTED
+
+
+def test_zip_with_several_layers_reads_the_chosen_one(tmp_path):
+    path = zip_export(tmp_path, ("Abandoned.csv", GEOJSON_EXPORT), ("Diversions.csv", CSV_EXPORT))
+
+    by_name = read_export(path, FIELDS, DATE_FIELDS, numeric_fields=NUMERIC_FIELDS, layer="Diversions")
+    by_index = read_export(path, FIELDS, DATE_FIELDS, numeric_fields=NUMERIC_FIELDS, layer=1)
+
+    assert by_name == by_index == EXPECTED
+
+
+def test_zip_with_several_layers_must_name_one(tmp_path):
+    path = zip_export(tmp_path, ("Abandoned.csv", CSV_EXPORT), ("Diversions.csv", CSV_EXPORT))
+
+    with pytest.raises(ValueError, match="Abandoned.csv, Diversions.csv"):
+        read_export(path, FIELDS, DATE_FIELDS)
+    with pytest.raises(ValueError, match="no layer 'Missing'"):
+        read_export(path, FIELDS, DATE_FIELDS, layer="Missing")
+
+
+def test_export_without_object_ids_is_refused(tmp_path):
+    path = str(tmp_path / "export.csv")
+    with open(CSV_EXPORT, encoding="utf-8") as source, open(path, "w", encoding="utf-8", newline="") as f:
+        for line in source:
+            f.write(line.split(",", 1)[1])
+
+    with pytest.raises(ValueError, match="without an ObjectID; tried ObjectID, OBJECTID, objectid, FID"):
+        read_export(path, FIELDS, DATE_FIELDS)
+    with pytest.raises(ValueError, match="tried GlobalObjectID"):
+        read_export(path, FIELDS, DATE_FIELDS, object_id_field="GlobalObjectID")
+
+
+def test_unsupported_export_type():
+    with pytest.raises(ValueError):
+        read_export("export.xlsx", FIELDS)
+
+
+class FakeExportItem:
+    """Stand-in for the exported item whose first download times out"""
+    def __init__(self):
+        self.downloads = 0
+        self.deleted = False
+
+    def download(self, save_path):
+        self.downloads += 1
+        if self.downloads == 1:
+            raise TimeoutError("timed out")
+        return shutil.copy(CSV_EXPORT, save_path)
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeSurveyItem:
+    title = "Diversions"
+
+    def __init__(self):
+        self.exports = []
+
+    def export(self, title, export_format, wait=True):
+        item = FakeExportItem()
+        self.exports.append(item)
+        return item
+
+
+class FakeContent:
+    def __init__(self, item):
+        self.item = item
+
+    def get(self, item_id):
+        return self.item
+
+
+class FakeGIS:
+    def __init__(self, item):
+        self.content = FakeContent(item)
+
+
+def test_export_survey_results_exports_once_and_retries_the_download():
+    survey_item = FakeSurveyItem()
+    sleeps = []
+    caller = ThrottledCaller(rate_limiter=TokenBucket(rate=1000, capacity=1000),
+                             retry_policy=RetryPolicy(max_attempts=3), sleep=sleeps.append)
+    client = Survey123Client("url", "user", "password", caller=caller, gis=FakeGIS(survey_item))
+
+    rows = client.export_survey_results("id", FIELDS, DATE_FIELDS, numeric_fields=NUMERIC_FIELDS)
+
+    assert rows == EXPECTED
+    assert len(survey_item.exports) == 1
+    assert survey_item.exports[0].downloads == 2
+    assert survey_item.exports[0].deleted
+    assert len(sleeps) == 1
@@ -0,0 +1,117 @@
+import datetime
+import json
+
+import pytest
+import requests
+
+from Survey123Client import Survey123Client
+from Survey123Client.exceptions import FeatureServiceError
+from Survey123Client.rawquery import decode_query_response, epoch_ms_to_dates
+from Survey123Client.throttling import RetryPolicy, ThrottledCaller, TokenBucket
+
+FIELDS = {"DiversionDate": "DateOfVisit", "Discharge": "Total_CFS_Today", "UserId": "PersonDoingSurvey"}
+FIELD_DEFINITIONS = [
+    {"name": "OBJECTID", "type": "esriFieldTypeOID"},
+    {"name": "DateOfVisit", "type": "esriFieldTypeDate"},
+    {"name": "Total_CFS_Today", "type": "esriFieldTypeDouble"},
+    {"name": "PersonDoingSurvey", "type": "esriFieldTypeString"},
+]
+VISIT = 1760900000000
+
+
+def response_body(features):
+    return json.dumps({"objectIdFieldName": "OBJECTID",
+                       "fields": FIELD_DEFINITIONS,
+                       "features": [{"attributes": a} for a in features]}).encode("utf-8")
+
+
+def test_decode_maps_fields_and_converts_dates():
+    body = response_body([
+        {"OBJECTID": 1, "DateOfVisit": VISIT, "Total_CFS_Today": 12.5, "PersonDoingSurvey": "Jo"},
+        {"OBJECTID": 2, "DateOfVisit": None, "Total_CFS_Today": None, "PersonDoingSurvey": "Al"},
+    ])
+
+    rows = decode_query_response(body, FIELDS, "OBJECTID")
+
+    assert rows == {
+        1: {"DiversionDate": datetime.datetime.fromtimestamp(VISIT / 1e3).date(), "Discharge": 12.5, "UserId": "Jo"},
+        2: {"DiversionDate": None, "Discharge": None, "UserId": "Al"},
+    }
+
+
+def test_decode_empty_page():
+    assert decode_query_response(response_body([]), FIELDS, "OBJECTID") == {}
+
+
+def test_decode_error_body_raises_with_code():
+    body = b'{"error": {"code": 400, "message": "Unable to complete operation.", "details": ["bad where"]}}'
+
+    with pytest.raises(FeatureServiceError) as raised:
+        decode_query_response(body, FIELDS, "OBJECTID")
+
+    assert raised.value.code == 400
+    assert "Unable to complete operation." in str(raised.value)
+
+
+def test_epoch_ms_to_dates_matches_fromtimestamp():
+    values = [VISIT + hours * 3600000 for hours in range(-24, 25, 3)] + [None, 0]
+
+    expected = [None if v is None else datetime.datetime.fromtimestamp(v / 1e3).date() for v in values]
+
+    assert epoch_ms_to_dates(values) == expected
+
+
+def test_epoch_ms_to_dates_handles_empty_and_all_null():
+    assert epoch_ms_to_dates([]) == []
+    assert epoch_ms_to_dates([None, None]) == [None, None]
+
+
+class StallingSession:
+    """Stand-in for the GIS connection's requests session whose first post times out"""
+    def __init__(self):
+        self.timeouts = []
+
+    def post(self, url, data, timeout=None):
+        self.timeouts.append(timeout)
+        if len(self.timeouts) == 1:
+            raise requests.ReadTimeout("Read timed out.")
+        response = requests.Response()
+        response.status_code = 200
+        response._content = response_body([{"OBJECTID": 1, "DateOfVisit": VISIT, "Total_CFS_Today": 1.0,
+                                            "PersonDoingSurvey": "Jo"}])
+        return response
+
+
+class FakeConnection:
+    token = "token"
+
+    def __init__(self):
+        self._session = StallingSession()
+
+
+class FakeGIS:
+    def __init__(self):
+        self._con = FakeConnection()
+
+
+class FakeLayer:
+    url = "https://services.arcgis.com/layer/0"
+    properties = {"objectIdField": "OBJECTID", "maxRecordCount": 1000}
+
+    @staticmethod
+    def query(where, return_ids_only=False, **kwargs):
+        return {"objectIdFieldName": "OBJECTID", "objectIds": [1]}
+
+
+def test_stalled_raw_query_times_out_and_is_retried():
+    gis = FakeGIS()
+    sleeps = []
+    caller = ThrottledCaller(rate_limiter=TokenBucket(rate=1000, capacity=1000),
+                             retry_policy=RetryPolicy(max_attempts=3), sleep=sleeps.append)
+    client = Survey123Client("url", "user", "password", caller=caller, gis=gis, timeout=5)
+
+    rows = client.query_layer(FakeLayer(), FIELDS, raw=True)
+
+    assert list(rows) == [1]
+    assert gis._con._session.timeouts == [5, 5]
+    assert len(sleeps) == 1
@@ -0,0 +1,206 @@
+import re
+import threading
+import time
+
+import pytest
+
+from Survey123Client import Survey123Client
+from Survey123Client.exceptions import FeatureServiceError
+from Survey123Client.throttling import AdaptiveConcurrencyLimit, RetryPolicy, ThrottledCaller, TokenBucket
+
+
+class FakeFeature:
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+    def get_value(self, field_name):
+        return self.attributes[field_name]
+
+
+class FakeFeatureSet:
+    def __init__(self, features):
+        self.features = features
+
+
+class ThrottlingLayer:
+    """
+    Stand-in for a FeatureLayer holding ObjectIDs 1..row_count that answers the first request for each page with a
+    429, as ArcGIS Online does when a client queries too hard
+    """
+    properties = {"objectIdField": "OBJECTID", "maxRecordCount": 100}
+
+    def __init__(self, row_count):
+        self.rows = {i: {"OBJECTID": i, "Total_CFS_Today": i / 10} for i in range(1, row_count + 1)}
+        self.page_requests = {}
+        self.__lock = threading.Lock()
+
+    def query(self, where, return_ids_only=False, **kwargs):
+        if return_ids_only:
+            return {"objectIdFieldName": "OBJECTID", "objectIds": list(self.rows)}
+        low, high = map(int, re.search(r"OBJECTID >= (\d+) AND OBJECTID <= (\d+)", where).groups())
+        with self.__lock:
+            self.page_requests[low] = self.page_requests.get(low, 0) + 1
+            if self.page_requests[low] == 1:
+                raise FeatureServiceError(429, "Too many requests")
+        return FakeFeatureSet([FakeFeature(r) for i, r in self.rows.items() if low <= i <= high])
+
+
+class FakeGIS:
+    pass
+
+
+def make_caller(sleeps):
+    return ThrottledCaller(rate_limiter=TokenBucket(rate=1000, capacity=1000),
+                           concurrency_limit=AdaptiveConcurrencyLimit(initial=4, maximum=4),
+                           retry_policy=RetryPolicy(max_attempts=4),
+                           sleep=sleeps.append)
+
+
+def test_query_layer_returns_every_row_once_despite_throttling():
+    layer = ThrottlingLayer(1050)
+    sleeps = []
+    caller = make_caller(sleeps)
+    client = Survey123Client("url", "user", "password", caller=caller, gis=FakeGIS())
+
+    results = client.query_layer(layer, {"Discharge": "Total_CFS_Today"})
+
+    assert sorted(results) == list(range(1, 1051))
+    assert results[1050] == {"Discharge": 105.0}
+    # 11 pages, each throttled once and then fetched once
+    assert sorted(layer.page_requests) == list(range(1, 1051, 100))
+    assert set(layer.page_requests.values()) == {2}
+    assert len(sleeps) == 11
+    assert caller.RateLimiter.Rate < 1000
+
+
+def test_query_layer_does_not_skip_rows_when_rows_are_deleted_mid_download():
+    layer = ThrottlingLayer(300)
+    original_query = layer.query
+
+    def query_then_delete(where, return_ids_only=False, **kwargs):
+        result = original_query(where, return_ids_only, **kwargs)
+        if return_ids_only:
+            del layer.rows[5]
+        return result
+
+    layer.query = query_then_delete
+    client = Survey123Client("url", "user", "password", caller=make_caller([]), gis=FakeGIS())
+
+    results = client.query_layer(layer, {"Discharge": "Total_CFS_Today"})
+
+    assert sorted(results) == [i for i in range(1, 301) if i != 5]
+
+
+def test_caller_raises_non_retryable_errors_straight_away():
+    sleeps = []
+    caller = make_caller(sleeps)
+    calls = []
+
+    def bad_query():
+        calls.append(1)
+        raise FeatureServiceError(400, "Unable to complete operation.")
+
+    with pytest.raises(FeatureServiceError):
+        caller.call(bad_query)
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_caller_gives_up_after_max_attempts():
+    sleeps = []
+    caller = make_caller(sleeps)
+    calls = []
+
+    def unavailable():
+        calls.append(1)
+        raise FeatureServiceError(503, "Service unavailable")
+
+    with pytest.raises(FeatureServiceError):
+        caller.call(unavailable)
+    assert len(calls) == 4
+    assert len(sleeps) == 3
+
+
+def test_caller_slows_rate_only_when_throttled():
+    caller = make_caller([])
+    attempts = []
+
+    def flaky(error):
+        def request():
+            attempts.append(1)
+            if len(attempts) % 2:
+                raise error
+            return "ok"
+        return request
+
+    assert caller.call(flaky(TimeoutError("timed out"))) == "ok"
+    assert caller.RateLimiter.Rate == 1000
+    assert caller.call(flaky(FeatureServiceError(429, "Too many requests"))) == "ok"
+    assert caller.RateLimiter.Rate < 1000
+
+
+@pytest.mark.parametrize("error, retryable, throttled", [
+    (FeatureServiceError(429, "Too many requests"), True, True),
+    (FeatureServiceError(503, "Service unavailable"), True, False),
+    (FeatureServiceError(400, "Unable to complete operation."), False, False),
+    (Exception("Unable to complete operation.\n(Error Code: 400)"), False, False),
+    (Exception("Too many requests.\n(Error Code: 429)"), True, True),
+    (Exception("Error Code: 502"), True, False),
+    (TimeoutError("timed out"), True, False),
+    (ConnectionResetError(), True, False),
+    (ValueError("bad value"), False, False),
+])
+def test_retry_policy_classifies_errors(error, retryable, throttled):
+    policy = RetryPolicy()
+    assert policy.is_retryable(error) == retryable
+    assert policy.is_throttled(error) == throttled
+
+
+def test_retry_policy_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=1.0, max_delay=10.0)
+    for attempt in range(1, 10):
+        assert 0 <= policy.backoff(attempt) <= min(10.0, 2 ** (attempt - 1))
+
+
+def test_token_bucket_waits_once_burst_is_spent():
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        time.sleep(seconds)
+
+    bucket = TokenBucket(rate=1000, capacity=3, sleep=sleep)
+    for _ in range(3):
+        bucket.acquire()
+    assert sleeps == []
+    bucket.acquire()
+    assert sleeps
+
+
+def test_token_bucket_halves_rate_when_throttled_and_recovers():
+    bucket = TokenBucket(rate=8, min_rate=1)
+    bucket.slow_down()
+    assert bucket.Rate == 4
+    for _ in range(5):
+        bucket.slow_down()
+    assert bucket.Rate == 1
+    for _ in range(100):
+        bucket.speed_up()
+    assert bucket.Rate == 8
+
+
+def test_concurrency_limit_adapts_to_latency_and_errors():
+    limit = AdaptiveConcurrencyLimit(initial=2, minimum=1, maximum=6)
+    for _ in range(50):
+        limit.acquire()
+        limit.release(latency=0.1)
+    assert limit.Limit == 6
+
+    limit.acquire()
+    limit.release(failed=True)
+    assert limit.Limit == 3
+
+    for _ in range(20):
+        limit.acquire()
+        limit.release(latency=1.0)
+    assert limit.Limit == 1
@@ -0,0 +1,205 @@
+import copy
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from Survey123Client.webhooks import WebhookQueue, WebhookReceiver
+
+SECRET = "s3cret"
+FIELDS = {
+    "LocationID": "LocationID",
+    "MeasurementTypeId": "MeasurementType",
+    "Discharge": "Total_CFS_Today",
+    "DiversionDate": "DateOfVisit",
+    "UserId": "PersonDoingSurvey",
+    "DeviceType": "Diversion_Type"
+}
+
+with open(os.path.join(os.path.dirname(__file__), "data", "webhook_add_data.json")) as f:
+    RECORDED_PAYLOAD = json.load(f)
+
+
+def payload(object_id, **attributes):
+    recorded = copy.deepcopy(RECORDED_PAYLOAD)
+    recorded["feature"]["attributes"].update(attributes, objectid=object_id)
+    recorded["feature"]["result"]["objectId"] = object_id
+    return recorded
+
+
+def require_visit_date(district_number, row):
+    if row["DiversionDate"] is None:
+        raise ValueError("DiversionDate is missing")
+
+
+class Flushes:
+    """
+    Records the batches handed to the receiver's flush function, failing any batch holding a negative discharge, or
+    every batch while the database is "down"
+    """
+    def __init__(self):
+        self.batches = []
+        self.imported = {}
+        self.down = False
+
+    def __call__(self, district_number, rows):
+        self.batches.append((district_number, rows))
+        if self.down:
+            raise RuntimeError("Database unavailable")
+        if any(row["Discharge"] < 0 for row in rows.values()):
+            raise RuntimeError("Discharge cannot be negative")
+        self.imported.update(rows)
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    flushes = Flushes()
+    server = WebhookReceiver(("127.0.0.1", 0), WebhookQueue(str(tmp_path / "queue.db")), {"61E": FIELDS},
+                             flushes, secret=SECRET, validate=require_visit_date,
+                             batch_size=3, batch_seconds=0.2, max_attempts=2, max_backoff_seconds=0.4)
+    server.flushes = flushes
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+    server.Queue.close()
+
+
+def post(server, path, body, token=SECRET):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    url = "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+    if token is not None:
+        url += "?token=" + token
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out waiting"
+        time.sleep(0.05)
+
+
+def test_recorded_payloads_reach_flush_as_mapped_rows(receiver):
+    assert post(receiver, "/61E", RECORDED_PAYLOAD) == 200
+    assert post(receiver, "/61E", payload(5722, Total_CFS_Today=3.0)) == 200
+
+    wait_for(lambda: len(receiver.flushes.imported) == 2)
+
+    assert receiver.flushes.imported[5721] == {
+        "LocationID": 10437,
+        "MeasurementTypeId": 1,
+        "Discharge": 12.5,
+        "DiversionDate": 1760900000000,
+        "UserId": "jsmith",
+        "DeviceType": "Open Channel"
+    }
+    assert receiver.flushes.imported[5722]["Discharge"] == 3.0
+    wait_for(lambda: receiver.Queue.count() == 0)
+
+
+def test_unknown_district_is_not_found(receiver):
+    assert post(receiver, "/99X", RECORDED_PAYLOAD) == 404
+    assert receiver.Queue.count() == 0
+
+
+@pytest.mark.parametrize("body", [b"not json", b"{}", b'{"feature": null}', b"[1, 2]"])
+def test_malformed_body_is_refused(receiver, body):
+    assert post(receiver, "/61E", body) == 400
+    assert receiver.Queue.count() == 0
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong"])
+def test_post_without_secret_is_forbidden(receiver, token):
+    assert post(receiver, "/61E", RECORDED_PAYLOAD, token=token) == 403
+    assert receiver.Queue.count() == 0
+
+
+def test_secret_may_be_sent_as_header(receiver):
+    url = "http://127.0.0.1:{}/61E".format(receiver.server_address[1])
+    request = urllib.request.Request(url, data=json.dumps(RECORDED_PAYLOAD).encode("utf-8"),
+                                     headers={"X-Webhook-Token": SECRET})
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 200
+
+
+def test_invalid_submission_is_refused_before_it_is_queued(receiver):
+    assert post(receiver, "/61E", payload(5722, DateOfVisit=None)) == 400
+    assert receiver.Queue.count() == 0
+
+
+def test_failing_submission_does_not_hold_back_the_rest(receiver):
+    assert post(receiver, "/61E", payload(1, Total_CFS_Today=-1.0)) == 200
+    assert post(receiver, "/61E", payload(2)) == 200
+    assert post(receiver, "/61E", payload(3)) == 200
+    assert post(receiver, "/61E", payload(4)) == 200
+
+    wait_for(lambda: receiver.Queue.dead_count() == 1 and receiver.Queue.count() == 0)
+
+    assert sorted(receiver.flushes.imported) == [2, 3, 4]
+
+    assert receiver.Queue.requeue_dead() == 1
+    assert receiver.Queue.dead_count() == 0
+
+
+def test_submission_without_object_id_is_refused(receiver):
+    anonymous = copy.deepcopy(RECORDED_PAYLOAD)
+    del anonymous["feature"]["result"]
+    del anonymous["feature"]["attributes"]["objectid"]
+
+    assert post(receiver, "/61E", anonymous) == 400
+    assert receiver.Queue.count() == 0
+
+
+def test_repeated_object_id_is_not_overwritten(receiver):
+    assert post(receiver, "/61E", payload(7, Total_CFS_Today=1.0)) == 200
+    assert post(receiver, "/61E", payload(7, Total_CFS_Today=2.0)) == 200
+
+    wait_for(lambda: receiver.Queue.count() == 0)
+
+    flushed = sorted(row["Discharge"] for _, rows in receiver.flushes.batches for row in rows.values())
+    assert flushed == [1.0, 2.0]
+
+
+def test_outage_does_not_count_against_submissions(receiver):
+    receiver.flushes.down = True
+    for object_id in range(1, 4):
+        assert post(receiver, "/61E", payload(object_id)) == 200
+
+    # Well past max_attempts rounds of failures
+    wait_for(lambda: len(receiver.flushes.batches) >= 12)
+    assert receiver.Queue.dead_count() == 0
+    assert receiver.Queue.count() == 3
+
+    receiver.flushes.down = False
+    wait_for(lambda: receiver.Queue.count() == 0)
+    assert sorted(receiver.flushes.imported) == [1, 2, 3]
+
+
+def test_receiver_requires_a_secret(tmp_path):
+    with pytest.raises(ValueError):
+        WebhookReceiver(("127.0.0.1", 0), WebhookQueue(str(tmp_path / "queue.db")), {"61E": FIELDS},
+                        lambda district_number, rows: None, secret="")
+
+
+def test_queued_submissions_survive_a_restart(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = WebhookQueue(path)
+    queue.put("61E", 5721, {"Discharge": 12.5})
+    queue.close()
+
+    queue = WebhookQueue(path)
+    assert queue.peek(10) == {"61E": [(1, 5721, {"Discharge": 12.5})]}
+    queue.close()
@@ -4,9 +4,12 @@ import MeasurementDatabaseClient
 import json
 import logging.config
 
+import MeasurementDatabaseClient.DistrictLeaseService
 import MeasurementDatabaseClient.WaterDistrictDataService
 import MeasurementDatabaseClient.repositories
 from Survey123Client import Survey123Client
+from Survey123Client.exports import read_export
+from Survey123Client.throttling import AdaptiveConcurrencyLimit, RetryPolicy, ThrottledCaller, TokenBucket
 
 
 def main():
@@ -34,57 +37,206 @@ def main():
         survey_dict = config["Surveys"]
         host_dict = config["SurveyHosts"]
 
+        lease_service = None
+        if "Leases" in config:
+            lease_service = create_lease_service(config["Leases"], conn_string)
+            lease_service.prepare(list(survey_dict.keys()))
+            logger.info("Sharing surveys with other instances as '{}'".format(lease_service.Owner))
+
+        callers = {host_name: create_throttled_caller(host_info.get("Throttling", {}), logger)
+                   for host_name, host_info in host_dict.items()}
+
         for district_number, survey_info in survey_dict.items():
+            lease = None
+            if lease_service is not None:
+                lease = lease_service.try_acquire(district_number)
+                if lease is None:
+                    logger.info("Skipping '{}' survey; another instance holds its lease".format(district_number))
+                    continue
             logger.info("Processing '{}' survey".format(district_number))
-            host_info = host_dict[survey_info["host"]]
-            client = Survey123Client(
-                url=host_info["url"],
-                username=host_info["username"],
-                password=host_info["password"]
-            )
-            data_service = MeasurementDatabaseClient.WaterDistrictDataService.WaterDistrictDataService(conn_string)
+            try:
+                result = import_survey(district_number, survey_info, host_dict[survey_info["host"]],
+                                       callers[survey_info["host"]], conn_string, pd_repository, lease, logger)
+            except Exception as e:
+                # Carry on with the remaining districts; this one will be picked up again on the next run
+                logger.exception(msg="Unable to import '{}' survey".format(district_number), exc_info=e)
+                if lease is not None:
+                    lease.release(completed=False)
+                continue
+            if result is not None:
+                load_logger.add_result(result)
+
+        load_logger.finalize()
 
+    except Exception as e:
+        logger.exception(msg="Unhandled exception in Survey123DataImport", exc_info=e)
+
+
+def import_survey(district_number: str, survey_info: dict, host_info: dict, caller: ThrottledCaller,
+                  conn_string: str, pd_repository, lease, logger: logging.Logger):
+    """
+    Imports one district's survey results into the measurement database
+    :param district_number: Water district number the survey belongs to
+    :param survey_info: The district's entry in the "Surveys" section of the config file
+    :param host_info: The survey's entry in the "SurveyHosts" section of the config file
+    :param caller: ThrottledCaller shared by every survey on the same host
+    :param conn_string: Connection string of the measurement database
+    :param pd_repository: WdHydrologyPdRepository used to look up diversions
+    :param lease: DistrictLease held on the district, or None if leases are not in use
+    :param logger: Logger
+    :return: SurveyLoadResult, or None if the lease was lost before the data could be committed
+    """
+    data_service = MeasurementDatabaseClient.WaterDistrictDataService.WaterDistrictDataService(conn_string)
+    date_fields = [survey_info["fields"]["DiversionDate"]]
+    # CSV exports hold every value as text; only these fields are turned back into numbers
+    numeric_fields = [service_field_name for database_field_name, service_field_name in survey_info["fields"].items()
+                      if database_field_name in ("SpatialDataID", "LocationID", "MeasurementTypeId", "Discharge")]
+
+    if "export_path" in survey_info:
+        # Already-downloaded export; no need to contact ArcGIS Online at all
+        survey_returns = read_export(survey_info["export_path"], survey_info["fields"], date_fields,
+                                     numeric_fields=numeric_fields, layer=survey_info.get("export_layer"))
+    else:
+        client = Survey123Client(
+            url=host_info["url"],
+            username=host_info["username"],
+            password=host_info["password"],
+            caller=caller
+        )
+        if survey_info.get("bulk", False):
+            survey_returns = client.export_survey_results(
+                survey_id=survey_info["id"],
+                field_dict=survey_info["fields"],
+                date_fields=date_fields,
+                numeric_fields=numeric_fields,
+                layer=survey_info.get("export_layer")
+            )
+        else:
             cutoff_date = data_service.get_earliest_date_of_last_measurement_for_water_district(district_number)
             where_clause = cutoff_date.strftime("\"DateOfVisit\" > DATE '%Y-%m-%d'")
 
             survey_returns = client.retrieve_survey_results(
                 survey_id=survey_info["id"],
                 field_dict=survey_info["fields"],
-                where_clause=where_clause
+                where_clause=where_clause,
+                raw=survey_info.get("fast_query", False)
             )
 
-            records_to_be_imported = []
+    records_to_be_imported = create_measurements(survey_returns, pd_repository)
 
-            for object_id, r in survey_returns.items():
-                related_pd = pd_repository.get_by_location_id(r["SpatialDataID"])
-                if related_pd is None:
-                    continue
-                data = MeasurementDatabaseClient.WdWaterMasterData(
-                        WdHydrologyPdId=related_pd.ID,
-                        HydrologyId=related_pd.HydrologyId,
-                        MeasurementTypeId=r["MeasurementTypeId"] or 4,
-                        Discharge=r["Discharge"],
-                        DiversionDate=datetime.datetime.fromtimestamp(r["DiversionDate"] / 1e3).date(),
-                        UserId=r["UserId"],
-                        RegistrationId='45D3E06E-AAB9-46CD-A799-49096572F48D'
-                    )
-                device_type = MeasurementDatabaseClient.DeviceType.parse(r["DeviceType"])
-                records_to_be_imported.append(MeasurementDatabaseClient.WdWaterMasterDataMetadata(data, device_type))
-
-            data_service.import_measurements(records_to_be_imported)
-
-            load_logger.add_result(SurveyLoadResult(
-                district_number,
-                data_service.Successes,
-                data_service.DuplicateRows,
-                [InvalidRow(r.ID, r.Message) for r in data_service.InvalidRows],
-                data_service.TotalMeasurements,
-                data_service.Interpolations))
+    # Stop (and roll back) as soon as the lease is lost so two instances never write the same district.  The lease
+    # can still expire in the instant between the last check and the commit; the unique constraint on
+    # wdWaterMasterData is the last safeguard against that.
+    if not data_service.import_measurements(records_to_be_imported,
+                                            is_cancelled=lambda: lease is not None and lease.Lost):
+        logger.error("Lost lease on '{}' survey while importing{}; leaving it to the new holder"
+                     .format(district_number, "" if lease.Error is None else " ({})".format(lease.Error)))
+        lease.release(completed=False)
+        return None
+    if lease is not None:
+        lease.release()
 
-        load_logger.finalize()
+    return SurveyLoadResult(
+        district_number,
+        data_service.Successes,
+        data_service.DuplicateRows,
+        [InvalidRow(r.ID, r.Message) for r in data_service.InvalidRows],
+        data_service.TotalMeasurements,
+        data_service.Interpolations)
 
-    except Exception as e:
-        logger.exception(msg="Unhandled exception in Survey123DataImport", exc_info=e)
+
+def create_measurements(survey_returns: dict, pd_repository):
+    """
+    Turns survey results into measurements ready to be imported
+    :param survey_returns: Dictionary of mapped survey results keyed by ObjectID
+    :param pd_repository: WdHydrologyPdRepository used to look up diversions
+    :return: list of WdWaterMasterDataMetadata; results whose location has no diversion are left out
+    """
+    records_to_be_imported = []
+
+    for object_id, r in survey_returns.items():
+        related_pd = pd_repository.get_by_location_id(r["SpatialDataID"])
+        if related_pd is None:
+            continue
+        data = MeasurementDatabaseClient.WdWaterMasterData(
+                WdHydrologyPdId=related_pd.ID,
+                HydrologyId=related_pd.HydrologyId,
+                MeasurementTypeId=r["MeasurementTypeId"] or 4,
+                Discharge=r["Discharge"],
+                DiversionDate=to_diversion_date(r["DiversionDate"]),
+                UserId=r["UserId"],
+                RegistrationId='45D3E06E-AAB9-46CD-A799-49096572F48D'
+            )
+        device_type = MeasurementDatabaseClient.DeviceType.parse(r["DeviceType"])
+        records_to_be_imported.append(MeasurementDatabaseClient.WdWaterMasterDataMetadata(data, device_type))
+
+    return records_to_be_imported
+
+
+def validate_survey_row(row: dict):
+    """
+    Checks that a mapped survey result has what create_measurements needs
+    :param row: Mapped survey result
+    :return: Nothing
+    :raises ValueError: if the result cannot be imported
+    """
+    if row.get("DiversionDate") is None:
+        raise ValueError("DiversionDate is missing")
+    try:
+        to_diversion_date(row["DiversionDate"])
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ValueError("DiversionDate '{}' is not a date".format(row["DiversionDate"]))
+    if not row.get("DeviceType"):
+        raise ValueError("DeviceType is missing")
+
+
+def to_diversion_date(value):
+    """
+    Converts a survey date value to a date.  Feature queries return epoch milliseconds; the fast query path and exports
+    have already converted them
+    :param value: datetime.date, or milliseconds since the epoch
+    :return: datetime.date
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.fromtimestamp(value / 1e3).date()
+
+
+def create_throttled_caller(throttling_config: dict, logger: logging.Logger):
+    """
+    Creates the rate limiter, concurrency limit and retry policy shared by all surveys on one host
+    :param throttling_config: "Throttling" section of a host in the config file (may be empty)
+    :param logger: Logger that retries are reported to
+    :return: ThrottledCaller
+    """
+    return ThrottledCaller(
+        rate_limiter=TokenBucket(
+            rate=throttling_config.get("RequestsPerSecond", 5),
+            capacity=throttling_config.get("BurstSize", 10)),
+        concurrency_limit=AdaptiveConcurrencyLimit(
+            maximum=throttling_config.get("MaxConcurrency", 8)),
+        retry_policy=RetryPolicy(
+            max_attempts=throttling_config.get("MaxAttempts", 6),
+            max_delay=throttling_config.get("MaxBackoffSeconds", 60)),
+        logger=logger
+    )
+
+
+def create_lease_service(lease_config: dict, default_conn_string: str):
+    """
+    Creates the service used to share districts with other instances of this script
+    :param lease_config: "Leases" section of the config file
+    :param default_conn_string: Connection string used if the "Leases" section does not name its own
+    :return: DistrictLeaseService
+    """
+    return MeasurementDatabaseClient.DistrictLeaseService.DistrictLeaseService(
+        lease_config.get("ConnectionString", default_conn_string),
+        lease_duration=datetime.timedelta(seconds=lease_config.get("LeaseSeconds", 300)),
+        heartbeat_interval=datetime.timedelta(seconds=lease_config.get("HeartbeatSeconds", 60)),
+        completed_hold=datetime.timedelta(seconds=lease_config.get("CompletedHoldSeconds", 0))
+    )
 
 
 def guess_at_device_type(hydro_id: int):
@@ -0,0 +1,75 @@
+import json
+import logging.config
+
+import MeasurementDatabaseClient.WaterDistrictDataService
+import MeasurementDatabaseClient.repositories
+from Survey123Client.webhooks import WebhookQueue, WebhookReceiver
+from Survey123DataImport import InvalidRow, SurveyLoadLogger, SurveyLoadResult, create_measurements, \
+    validate_survey_row
+
+
+def main():
+    logging.basicConfig(
+        filename=".\\logs\\BasicSurvey123WebhookReceiver.log",
+        level=logging.DEBUG,
+        format='[%(asctime)s] - %(message)s',
+        datefmt='%H:%M:%S'
+    )
+    logger = logging.getLogger("BasicSurvey123WebhookReceiver")
+
+    try:
+        config = json.load(open("config.json", "r"))
+
+        # create logger
+        logging.config.dictConfig(config["Logging"])
+        # noinspection PyShadowingNames
+        logger = logging.getLogger('Survey123WebhookReceiver')
+
+        conn_string = config["ConnectionStrings"]["MeasurementDatabaseClient"]
+        webhook_config = config["Webhook"]
+
+        def flush(district_number: str, survey_returns: dict):
+            logger.info("Importing {} webhook submissions for '{}' survey".format(len(survey_returns), district_number))
+            with MeasurementDatabaseClient.repositories.WdHydrologyPdRepository(conn_string) as pd_repository:
+                records_to_be_imported = create_measurements(survey_returns, pd_repository)
+            data_service = MeasurementDatabaseClient.WaterDistrictDataService.WaterDistrictDataService(conn_string)
+            data_service.import_measurements(records_to_be_imported)
+            # Each batch gets its own summary so invalid rows are reported (and emailed) while the receiver runs
+            load_logger = SurveyLoadLogger(logger)
+            load_logger.add_result(SurveyLoadResult(
+                district_number,
+                data_service.Successes,
+                data_service.DuplicateRows,
+                [InvalidRow(r.ID, r.Message) for r in data_service.InvalidRows],
+                data_service.TotalMeasurements,
+                data_service.Interpolations))
+            load_logger.finalize()
+
+        receiver = WebhookReceiver(
+            (webhook_config.get("host", "127.0.0.1"), webhook_config.get("port", 8123)),
+            WebhookQueue(webhook_config.get("queue_path", "webhook_queue.db")),
+            {district_number: survey_info["fields"] for district_number, survey_info in config["Surveys"].items()},
+            flush,
+            secret=webhook_config["secret"],
+            validate=lambda district_number, row: validate_survey_row(row),
+            batch_size=webhook_config.get("batch_size", 100),
+            batch_seconds=webhook_config.get("batch_seconds", 30),
+            max_attempts=webhook_config.get("max_attempts", 5),
+            max_backoff_seconds=webhook_config.get("max_backoff_seconds", 600),
+            logger=logger
+        )
+        logger.info("Listening for Survey123 webhooks on {}:{}".format(*receiver.server_address))
+        try:
+            receiver.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            receiver.server_close()
+            receiver.Queue.close()
+
+    except Exception as e:
+        logger.exception(msg="Unhandled exception in Survey123WebhookReceiver", exc_info=e)
+
+
+if __name__ == '__main__':
+    main()